@@ -330,8 +330,8 @@ class CLIP4clipLitModule(LightningModule):
 
         scores = compute_scores(
             retrieve_logits,
-            recipe_kitchen_ap_ids[is_pool].to(device),
-            recipe_kitchen_ap_ids[is_query].to(device),
+            *recipe_kitchen_ap_ids[is_pool].to(device).unbind(dim=1),
+            *recipe_kitchen_ap_ids[is_query].to(device).unbind(dim=1),
         )
 
         return scores, sum(is_pool), sum(is_query)
@@ -1,4 +1,4 @@
-from typing import List
+from typing import List, Sequence
 
 import numpy as np
 import torch
@@ -82,55 +82,71 @@ def tensor_video_to_text_sim(sim_tensor):
 
 
 # retrieval metrics
-def v2t_score(
+# ids are passed as one 1-d tensor per column: (recipe_ids, kitchen_ids, ap_ids)
+def v2t_ranks(
     sim_logits: Tensor,
-    matched_mask: Tensor,
     pool_mask: Tensor = None,
-    at=1,
 ):
     if pool_mask is not None:
         sim_logits = sim_logits.masked_fill(~pool_mask, torch.inf)
 
     # ranks for each pair (same rank for equivalents)
-    ranks = rank_tensor(sim_logits, method="min")
+    return rank_tensor(sim_logits, method="min")
 
-    # score
-    if at == "mean":
-        m_score = masked_mean(ranks, matched_mask)
-    elif at == "median":
-        # m_score = masked_median(ranks, matched_mask)
-        min_ranks = ranks.masked_fill(~matched_mask, ranks.max() + 1).min(dim=-1)[0]
-        m_score = float(torch.median(min_ranks))
-    else:
-        # minimum rank for each video
-        min_ranks = ranks.masked_fill(~matched_mask, ranks.max() + 1).min(dim=-1)[0]
-        m_score = float(sum(min_ranks < at)) * 100 / len(min_ranks)
 
-    return m_score
+def v2t_min_ranks(
+    sim_logits: Tensor,
+    matched_mask: Tensor,
+    pool_mask: Tensor = None,
+):
+    ranks = v2t_ranks(sim_logits, pool_mask)
+
+    # minimum rank for each video
+    return ranks.masked_fill(~matched_mask, ranks.max() + 1).min(dim=-1)[0]
 
 
-def get_matched_matrix(
-    seq_ids: Tensor,
-    vid_ids: Tensor,
+def min_ranks_score(
+    min_ranks: Tensor,
+    at=1,
 ):
-    n_vid = vid_ids.size(0)
-    n_seq = seq_ids.size(0)
+    if at == "median":
+        return float(torch.median(min_ranks))
+    else:
+        return (min_ranks < at).sum().item() * 100 / len(min_ranks)
 
-    vid_ids = vid_ids.unsqueeze(1).repeat(1, n_seq, 1)
-    seq_ids = seq_ids.unsqueeze(0).repeat(n_vid, 1, 1)
 
-    match_matrix = (vid_ids == seq_ids).all(dim=-1)
+def v2t_score(
+    sim_logits: Tensor,
+    matched_mask: Tensor,
+    pool_mask: Tensor = None,
+    at=1,
+):
+    if at == "mean":
+        return masked_mean(v2t_ranks(sim_logits, pool_mask), matched_mask)
+
+    return min_ranks_score(v2t_min_ranks(sim_logits, matched_mask, pool_mask), at=at)
+
+
+def get_matched_matrix(
+    seq_ids: Sequence[Tensor],
+    vid_ids: Sequence[Tensor],
+):
+    match_matrix = None
+    for seq_id, vid_id in zip(seq_ids, vid_ids):
+        # (n_vid, 1) == (1, n_seq) -> (n_vid, n_seq)
+        column_matrix = vid_id.unsqueeze(1) == seq_id.unsqueeze(0)
+        match_matrix = column_matrix if match_matrix is None else match_matrix & column_matrix
 
     return match_matrix
 
 
 def get_matched_matrix_from_json(
-    seq_ids: Tensor,
-    vid_ids: Tensor,
+    seq_ids: Sequence[Tensor],
+    vid_ids: Sequence[Tensor],
     stage: str,
 ):
-    n_vid = vid_ids.size(0)
-    n_seq = seq_ids.size(0)
+    n_vid = vid_ids[0].size(0)
+    n_seq = seq_ids[0].size(0)
 
     import json
 
@@ -141,29 +157,57 @@ def get_matched_matrix_from_json(
     match_matrix = torch.zeros(n_vid, n_seq, dtype=torch.bool)
     for i in range(n_vid):
         for j in range(n_seq):
-            vid_id_str = str(vid_ids[i][0].item()) + "_" + str(vid_ids[i][1].item())
-            seq_id_str = str(seq_ids[j][0].item()) + "_" + str(seq_ids[j][1].item())
+            vid_id_str = str(vid_ids[0][i].item()) + "_" + str(vid_ids[1][i].item())
+            seq_id_str = str(seq_ids[0][j].item()) + "_" + str(seq_ids[1][j].item())
             if vid_id_str == seq_id_str:
                 match_matrix[i][j] = True
             elif vid_id_str in feasible_recipe and seq_id_str in feasible_recipe[vid_id_str]:
                 match_matrix[i][j] = True
 
-    match_matrix = match_matrix.to(seq_ids.device)
+    match_matrix = match_matrix.to(seq_ids[0].device)
     return match_matrix
 
 
-def v2t_m1_score(
+def aggregate_recipe_kitchen(
     sim_logits: Tensor,
-    seq_ids: Tensor,
-    vid_ids: Tensor,
-    at=1,
+    seq_ids: Sequence[Tensor],
 ):
     # reduce sim_logits to recipe/kitchen-granularity
-    agg_sim_logits, agg_seq_ids = scatter_min_2d_label(sim_logits.T, seq_ids[:, :2])
-    agg_sim_logits = agg_sim_logits.T
+    agg_sim_logits, agg_seq_ids = scatter_min_2d_label(
+        sim_logits.T, torch.stack(seq_ids[:2], dim=1)
+    )
 
-    vid_ids = vid_ids[:, :2]
-    matched_matrix = get_matched_matrix(agg_seq_ids, vid_ids)
+    return agg_sim_logits.T, agg_seq_ids.unbind(dim=1)
+
+
+def _v2t_m1_inputs(
+    sim_logits: Tensor,
+    seq_ids: Sequence[Tensor],
+    vid_ids: Sequence[Tensor],
+):
+    agg_sim_logits, agg_seq_ids = aggregate_recipe_kitchen(sim_logits, seq_ids)
+    matched_matrix = get_matched_matrix(agg_seq_ids, vid_ids[:2])
+
+    return agg_sim_logits, matched_matrix
+
+
+def v2t_m1_min_ranks(
+    sim_logits: Tensor,
+    seq_ids: Sequence[Tensor],
+    vid_ids: Sequence[Tensor],
+):
+    agg_sim_logits, matched_matrix = _v2t_m1_inputs(sim_logits, seq_ids, vid_ids)
+
+    return v2t_min_ranks(sim_logits=agg_sim_logits, matched_mask=matched_matrix)
+
+
+def v2t_m1_score(
+    sim_logits: Tensor,
+    seq_ids: Sequence[Tensor],
+    vid_ids: Sequence[Tensor],
+    at=1,
+):
+    agg_sim_logits, matched_matrix = _v2t_m1_inputs(sim_logits, seq_ids, vid_ids)
 
     return v2t_score(
         sim_logits=agg_sim_logits,
@@ -174,17 +218,13 @@ def v2t_m1_score(
 
 def v2t_FEASIBLE_score(
     sim_logits: Tensor,
-    seq_ids: Tensor,
-    vid_ids: Tensor,
+    seq_ids: Sequence[Tensor],
+    vid_ids: Sequence[Tensor],
     at=1,
     stage="early",
 ):
-    # reduce sim_logits to recipe/kitchen-granularity
-    agg_sim_logits, agg_seq_ids = scatter_min_2d_label(sim_logits.T, seq_ids[:, :2])
-    agg_sim_logits = agg_sim_logits.T
-
-    vid_ids = vid_ids[:, :2]
-    matched_matrix = get_matched_matrix_from_json(agg_seq_ids, vid_ids, stage=stage)
+    agg_sim_logits, agg_seq_ids = aggregate_recipe_kitchen(sim_logits, seq_ids)
+    matched_matrix = get_matched_matrix_from_json(agg_seq_ids, vid_ids[:2], stage=stage)
 
     return v2t_score(
         sim_logits=agg_sim_logits,
@@ -193,14 +233,37 @@ def v2t_FEASIBLE_score(
     )
 
 
+def _v2t_m2_masks(
+    seq_ids: Sequence[Tensor],
+    vid_ids: Sequence[Tensor],
+):
+    pool_mask = get_matched_matrix(seq_ids[:2], vid_ids[:2])
+    matched_mask = pool_mask & get_matched_matrix(seq_ids[2:], vid_ids[2:])
+
+    return pool_mask, matched_mask
+
+
+def v2t_m2_min_ranks(
+    sim_logits: Tensor,
+    seq_ids: Sequence[Tensor],
+    vid_ids: Sequence[Tensor],
+):
+    pool_mask, matched_mask = _v2t_m2_masks(seq_ids, vid_ids)
+
+    return v2t_min_ranks(
+        sim_logits=sim_logits,
+        pool_mask=pool_mask,
+        matched_mask=matched_mask,
+    )
+
+
 def v2t_m2_score(
     sim_logits: Tensor,
-    seq_ids: Tensor,
-    vid_ids: Tensor,
+    seq_ids: Sequence[Tensor],
+    vid_ids: Sequence[Tensor],
     at=1,
 ):
-    pool_mask = get_matched_matrix(seq_ids[:, :2], vid_ids[:, :2])
-    matched_mask = get_matched_matrix(seq_ids, vid_ids)
+    pool_mask, matched_mask = _v2t_m2_masks(seq_ids, vid_ids)
 
     return v2t_score(
         sim_logits=sim_logits,
@@ -212,8 +275,8 @@ def v2t_m2_score(
 
 def v2t_m3_score(
     sim_logits: Tensor,
-    seq_ids: Tensor,
-    vid_ids: Tensor,
+    seq_ids: Sequence[Tensor],
+    vid_ids: Sequence[Tensor],
     at=1,
 ):
     matched_mask = get_matched_matrix(seq_ids, vid_ids)
@@ -227,17 +290,27 @@ def v2t_m3_score(
 
 def compute_scores(
     sim_matrix: Tensor,
-    sequence_ids: Tensor,
-    video_ids: Tensor,
+    pool_recipe_ids: Tensor,
+    pool_kitchen_ids: Tensor,
+    pool_ap_ids: Tensor,
+    query_recipe_ids: Tensor,
+    query_kitchen_ids: Tensor,
+    query_ap_ids: Tensor,
     stage: str = "early",
 ):
+    # ids are kept as one 1-d tensor per column (recipe, kitchen, ap)
+    sequence_ids = (pool_recipe_ids, pool_kitchen_ids, pool_ap_ids)
+    video_ids = (query_recipe_ids, query_kitchen_ids, query_ap_ids)
+
     metrics = {}
 
-    metrics["M1-R1"] = v2t_m1_score(sim_matrix, sequence_ids, video_ids, at=1)
-    metrics["M1-R5"] = v2t_m1_score(sim_matrix, sequence_ids, video_ids, at=5)
-    metrics["M1-R10"] = v2t_m1_score(sim_matrix, sequence_ids, video_ids, at=10)
+    # ranks are shared by every cut-off, so compute them once per metric
+    m1_min_ranks = v2t_m1_min_ranks(sim_matrix, sequence_ids, video_ids)
+    metrics["M1-R1"] = min_ranks_score(m1_min_ranks, at=1)
+    metrics["M1-R5"] = min_ranks_score(m1_min_ranks, at=5)
+    metrics["M1-R10"] = min_ranks_score(m1_min_ranks, at=10)
     # metrics["M1-mean"] = v2t_m1_score(sim_matrix, sequence_ids, video_ids, at="mean")
-    metrics["M1-median"] = v2t_m1_score(sim_matrix, sequence_ids, video_ids, at="median")
+    metrics["M1-median"] = min_ranks_score(m1_min_ranks, at="median")
 
     # As feasible recipe retrieval requires a private dataset CRD, we just ignore the metrics.
     # metrics["FEAS-R1"] = v2t_FEASIBLE_score(sim_matrix, sequence_ids, video_ids, at=1, stage=stage)
@@ -251,11 +324,12 @@ def compute_scores(
     #     sim_matrix, sequence_ids, video_ids, at="median", stage=stage
     # )
 
-    metrics["M2-R1"] = v2t_m2_score(sim_matrix, sequence_ids, video_ids, at=1)
-    metrics["M2-R5"] = v2t_m2_score(sim_matrix, sequence_ids, video_ids, at=5)
-    metrics["M2-R10"] = v2t_m2_score(sim_matrix, sequence_ids, video_ids, at=10)
+    m2_min_ranks = v2t_m2_min_ranks(sim_matrix, sequence_ids, video_ids)
+    metrics["M2-R1"] = min_ranks_score(m2_min_ranks, at=1)
+    metrics["M2-R5"] = min_ranks_score(m2_min_ranks, at=5)
+    metrics["M2-R10"] = min_ranks_score(m2_min_ranks, at=10)
     # metrics["M2-mean"] = v2t_m2_score(sim_matrix, sequence_ids, video_ids, at="mean")
-    metrics["M2-median"] = v2t_m2_score(sim_matrix, sequence_ids, video_ids, at="median")
+    metrics["M2-median"] = min_ranks_score(m2_min_ranks, at="median")
 
     # metrics["M3-R1"] = v2t_m3_score(sim_matrix, sequence_ids, video_ids, at=1)
     # metrics["M3-R5"] = v2t_m3_score(sim_matrix, sequence_ids, video_ids, at=5)
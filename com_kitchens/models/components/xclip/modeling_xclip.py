@@ -216,6 +216,24 @@ class XCLIP(CLIP4ClipPreTrainedModel):
             video_frame=video_frame,
         )
 
+        return self.get_loss(
+            sequence_output,
+            seq_features,
+            visual_output,
+            attention_mask,
+            video_mask,
+            shaped=True,
+        )
+
+    def get_loss(
+        self,
+        sequence_output,
+        seq_features,
+        visual_output,
+        attention_mask,
+        video_mask,
+        shaped=False,
+    ):
         loss = 0.0
         sim_matrix, *_tmp = self.get_similarity_logits(
             sequence_output,
@@ -223,7 +241,7 @@ class XCLIP(CLIP4ClipPreTrainedModel):
             visual_output,
             attention_mask,
             video_mask,
-            shaped=True,
+            shaped=shaped,
             loose_type=self.loose_type,
         )
         sim_loss1 = self.loss_fct(sim_matrix)
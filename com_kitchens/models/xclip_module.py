@@ -1,11 +1,14 @@
 import logging
+import math
+import re
 from argparse import Namespace
-from typing import Any, List, Optional, Type
+from typing import Any, Dict, List, Optional
 
 import torch
 import torch.distributed as dist
 from lightning import LightningModule
 from lightning.pytorch.utilities.types import _METRIC
+from torch import Tensor
 from torchmetrics import MaxMetric, MeanMetric
 
 from com_kitchens.models.components.metrics.retrieval_metrics import compute_scores
@@ -14,6 +17,65 @@ from com_kitchens.models.components.xclip.optimization import BertAdam
 
 logger = logging.getLogger(__name__)
 
+SCALAR_METRICS = [
+    # val
+    "val/M1-R@1",
+    "val/M1-R@5",
+    "val/M1-R@10",
+    "val/M2-R@1",
+    "val/M2-R@5",
+    "val/M2-R@10",
+    # test
+    # "test/FEAS-R@1",
+    # "test/FEAS-R@5",
+    # "test/FEAS-R@10",
+    # "test/FEAS-median",
+    "test/M2-R@1",
+    "test/M2-R@5",
+    "test/M2-R@10",
+    "test/M2-median",
+    "test/n_seq",
+    "test/n_vid",
+]
+
+# device memory needed to score an epoch, relative to the size of its outputs: the gathered
+# outputs, the query/pool selections, the gather receive buffers and the similarity intermediates
+SCORING_MEMORY_FACTOR = 4
+
+
+def _stack_key(outputs: List[Dict[str, Tensor]], key: str) -> Tensor:
+    """Concatenate `key` of every output along dim 0 into a single pre-sized buffer."""
+    sizes = [o[key].size(0) for o in outputs]
+    first = outputs[0][key]
+
+    buf = torch.empty((sum(sizes),) + first.shape[1:], dtype=first.dtype, device=first.device)
+    offset = 0
+    for o, size in zip(outputs, sizes):
+        buf[offset : offset + size].copy_(o[key])
+        offset += size
+
+    return buf
+
+
+def _local_concat(outputs: List[Dict[str, Tensor]]) -> Dict[str, Tensor]:
+    """Concatenate the step outputs of this rank key by key, releasing them as it goes."""
+    if len(outputs) == 0:
+        return {}
+
+    concat = {}
+    for key in list(outputs[0]):
+        concat[key] = _stack_key(outputs, key)
+        # the concatenated copy replaces the per-step tensors
+        for o in outputs:
+            del o[key]
+    outputs.clear()
+
+    return concat
+
+
+def _nbytes(outputs: Dict[str, Tensor]) -> int:
+    return sum(value.numel() * value.element_size() for value in outputs.values())
+
 
 class XCLIPLitModule(LightningModule):
     def __init__(
@@ -24,42 +86,34 @@ class XCLIPLitModule(LightningModule):
     ):
         super().__init__()
 
-        self.save_hyperparameters(logger=False)
+        # the state dict is consumed by from_pretrained, so don't keep another reference to it
+        self.save_hyperparameters(ignore=["clip_state_dict"], logger=False)
 
         # clip-state-dict は概ねNone
         self.model = XCLIP.from_pretrained(
             cross_model_name=self.hparams.cross_config,
             cache_dir=self.hparams.task_config.cache_dir,
-            state_dict=self.hparams.clip_state_dict,
+            state_dict=clip_state_dict,
             task_config=Namespace(**self.hparams.task_config),
         )
 
         self.valid_step_outputs = []
         self.test_step_outputs = []
 
-        # metric objects for calculating and averaging accuracy across batches
-        # val
-        self.val_m1_recall_at_1 = MeanMetric()
-        self.val_m1_recall_at_5 = MeanMetric()
-        self.val_m1_recall_at_10 = MeanMetric()
-
-        self.val_m2_recall_at_1 = MeanMetric()
-        self.val_m2_recall_at_5 = MeanMetric()
-        self.val_m2_recall_at_10 = MeanMetric()
-
-        # test
-        self.test_feasible_recall_at_1 = MeanMetric()
-        self.test_feasible_recall_at_5 = MeanMetric()
-        self.test_feasible_recall_at_10 = MeanMetric()
-        self.test_feasible_median = MeanMetric()
+        # gloo group for gathering step outputs (created in setup)
+        self._cpu_group = None
 
-        self.test_m2_recall_at_1 = MeanMetric()
-        self.test_m2_recall_at_5 = MeanMetric()
-        self.test_m2_recall_at_10 = MeanMetric()
-        self.test_m2_median = MeanMetric()
+        # device-to-host copies of step outputs run on a side stream (created lazily)
+        self._d2h_stream = None
+        self._d2h_events = []
+        # whether step outputs are spilled to host memory, decided on the first step of an epoch
+        self._spill = None
 
-        self.test_n_seq = MeanMetric()
-        self.test_n_vid = MeanMetric()
+        # epoch-level scalar metrics share a single pair of sum/count buffers
+        # so that they are synchronized with one collective
+        self._scalar_metrics = {name: idx for idx, name in enumerate(SCALAR_METRICS)}
+        self.register_buffer("_metric_sums", torch.zeros(len(SCALAR_METRICS)), persistent=False)
+        self.register_buffer("_metric_counts", torch.zeros(len(SCALAR_METRICS)), persistent=False)
 
         # for averaging loss across batches
         self.train_loss = MeanMetric()
@@ -68,16 +122,173 @@ class XCLIPLitModule(LightningModule):
         # for tracking best so far validation recall@1
         # self.val_m1_recall_at_1_best = MaxMetric()
 
-    def _gather_outputs(self, obj: Type) -> Optional[List[Type]]:
-        if not self.trainer.is_global_zero:
-            dist.gather_object(obj=obj, object_gather_list=None, dst=0)
+    def setup(self, stage: str) -> None:
+        # step outputs live on CPU, so gather them over gloo and leave NCCL to training
+        if self._cpu_group is None and dist.is_available() and dist.is_initialized():
+            self._cpu_group = dist.new_group(backend="gloo")
+
+    def _gather_outputs(self, outputs: Dict[str, Tensor]) -> Optional[Dict[str, Tensor]]:
+        """Gather the outputs of every rank to rank 0, consuming `outputs` key by key.
+
+        Other ranks return None.
+        """
+        if not (dist.is_available() and dist.is_initialized()):
+            if not self._keep_on_device(outputs, _nbytes(outputs)):
+                outputs = {key: outputs.pop(key).cpu() for key in list(outputs)}
+            return outputs
+
+        is_global_zero = self.trainer.is_global_zero
+
+        # a rank without batches has no outputs, so take keys/shapes/dtypes from the others;
+        # every output is per-sample, so all keys share the same length along dim 0
+        local_len = next(iter(outputs.values())).size(0) if outputs else 0
+        local_meta = {key: (tuple(value.shape[1:]), value.dtype) for key, value in outputs.items()}
+        metas = [None] * dist.get_world_size(group=self._cpu_group)
+        dist.all_gather_object(metas, (local_len, local_meta), group=self._cpu_group)
+        sizes = [size for size, _ in metas]
+        meta = next((m for _, m in metas if m), {})
+        if not meta:
+            return {} if is_global_zero else None
+
+        # outputs kept on device are gathered over the default (nccl) group, unless any rank
+        # spilled them to host memory or rank 0 no longer has room to score them there, in
+        # which case everything goes through gloo
+        row_bytes = sum(
+            math.prod(shape) * torch.empty((), dtype=dtype).element_size()
+            for shape, dtype in meta.values()
+        )
+        total_bytes = sum(sizes) * row_bytes
+        # only rank 0 receives the gathered outputs, so only rank 0 needs the room
+        on_device = torch.tensor(
+            [int(self._keep_on_device(outputs, total_bytes if is_global_zero else 0))]
+        )
+        dist.all_reduce(on_device, op=dist.ReduceOp.MIN, group=self._cpu_group)
+        if on_device.item():
+            group, device = None, self.device
+        else:
+            group, device = self._cpu_group, torch.device("cpu")
+            outputs = {key: outputs.pop(key).cpu() for key in list(outputs)}
+
+        world_size = dist.get_world_size(group=group)
+        max_size = max(sizes)
+
+        gathered_outputs = {}
+        for key, (shape, dtype) in meta.items():
+            # gather requires tensors of the same shape on every rank
+            padded = torch.zeros((max_size,) + shape, dtype=dtype, device=device)
+            if key in outputs:
+                # the local copy is no longer needed once it is in the send buffer
+                padded[:local_len] = outputs.pop(key)
+
+            # only rank 0 scores the outputs, so only rank 0 receives them
+            gathered = (
+                [torch.empty_like(padded) for _ in range(world_size)] if is_global_zero else None
+            )
+            dist.gather(padded, gather_list=gathered, dst=0, group=group)
+
+            if is_global_zero:
+                gathered_outputs[key] = torch.cat(
+                    [tensor[:size] for tensor, size in zip(gathered, sizes)]
+                )
+            del padded, gathered
+
+        if not is_global_zero:
             return None
-        else:  # global-zero only
-            list_gather_obj = [None] * self.trainer.world_size
-            dist.gather_object(obj=obj, object_gather_list=list_gather_obj, dst=0)
 
-            # return flatten
-            return [output for outputs in list_gather_obj for output in outputs]
+        return gathered_outputs
+
+    def _fits_on_device(self, nbytes: int) -> bool:
+        """Whether outputs of `nbytes` leave room on the device to be scored there."""
+        free, _ = torch.cuda.mem_get_info(self.device)
+        # blocks cached by the allocator can be reused as well
+        free += torch.cuda.memory_reserved(self.device) - torch.cuda.memory_allocated(self.device)
+        return free > SCORING_MEMORY_FACTOR * nbytes
+
+    def _keep_on_device(self, outputs: Dict[str, Tensor], nbytes: int) -> bool:
+        """Re-check, right before gathering, that outputs kept on the device still fit."""
+        if not all(value.is_cuda for value in outputs.values()):
+            return False
+
+        return nbytes == 0 or self._fits_on_device(nbytes)
+
+    def _should_spill(self, outputs: Dict[str, Tensor]) -> bool:
+        """Decide, once per epoch, whether the step outputs would not fit on the device."""
+        if self._spill is None:
+            if self.trainer.testing:
+                num_batches = sum(self.trainer.num_test_batches)
+            elif self.trainer.sanity_checking:
+                num_batches = sum(self.trainer.num_sanity_val_batches)
+            else:
+                num_batches = sum(self.trainer.num_val_batches)
+
+            # rank 0 ends up with the outputs of every rank
+            estimated = _nbytes(outputs) * num_batches * self.trainer.world_size
+            self._spill = not self._fits_on_device(estimated)
+
+        return self._spill
+
+    def _offload_step_outputs(self, outputs: Dict[str, Tensor]) -> Dict[str, Tensor]:
+        """Copy step outputs to (pinned) host memory without stalling the compute stream."""
+        if self.device.type != "cuda":
+            return {key: value.data.cpu() for key, value in outputs.items()}
+
+        # small evaluation sets stay on the device, avoiding the round trip through the host
+        if not self._should_spill(outputs):
+            return {key: value.data for key, value in outputs.items()}
+
+        if self._d2h_stream is None:
+            self._d2h_stream = torch.cuda.Stream(device=self.device)
+
+        # the copies must see the results of the forward pass
+        compute_stream = torch.cuda.current_stream(self.device)
+        self._d2h_stream.wait_stream(compute_stream)
+
+        host_outputs = {}
+        with torch.cuda.stream(self._d2h_stream):
+            for key, value in outputs.items():
+                # pinned blocks are recycled by the caching host allocator across steps/epochs
+                host_outputs[key] = torch.empty(
+                    value.shape, dtype=value.dtype, pin_memory=True
+                ).copy_(value.data, non_blocking=True)
+                # keep the device memory alive until the copy has finished
+                if value.is_cuda:
+                    value.record_stream(self._d2h_stream)
+
+            event = torch.cuda.Event()
+            event.record(self._d2h_stream)
+        self._d2h_events.append(event)
+
+        return host_outputs
+
+    def _wait_step_outputs(self) -> None:
+        """Block until all pending device-to-host copies of step outputs are complete."""
+        for event in self._d2h_events:
+            event.synchronize()
+        self._d2h_events[:] = []
+
+    def _reset_scalar_metrics(self, prefix: str) -> None:
+        for name, idx in self._scalar_metrics.items():
+            if name.startswith(prefix):
+                self._metric_sums[idx] = 0.0
+                self._metric_counts[idx] = 0.0
+
+    def _update_scalar_metric(self, name: str, value: float) -> None:
+        idx = self._scalar_metrics[name]
+        self._metric_sums[idx] += value
+        self._metric_counts[idx] += 1
+
+    def _log_scalar_metrics(self, prefix: str, **kwargs) -> None:
+        # sums and counts are reduced together with a single collective
+        totals = torch.stack([self._metric_sums, self._metric_counts])
+        if dist.is_available() and dist.is_initialized():
+            dist.all_reduce(totals)
+        sums, counts = totals
+
+        for name, idx in self._scalar_metrics.items():
+            if name.startswith(prefix):
+                # already reduced above, so lightning must not reduce it again (it warns once
+                # per key about sync_dist; extras.ignore_warnings silences that if needed)
+                self.log_on_epoch(name, sums[idx] / counts[idx], sync_dist=False, **kwargs)
 
     def log_on_epoch(
         self,
@@ -102,12 +313,13 @@ class XCLIPLitModule(LightningModule):
     def on_train_start(self):
         # by default lightning executes validation step sanity checks before training starts,
         # so it's worth to make sure validation metrics don't store results from these checks
-        self.val_m1_recall_at_1.reset()
-        self.val_m1_recall_at_5.reset()
-        self.val_m1_recall_at_10.reset()
-        self.val_m2_recall_at_1.reset()
-        self.val_m2_recall_at_5.reset()
-        self.val_m2_recall_at_10.reset()
+        self._reset_scalar_metrics("val/")
+
+    def on_train_epoch_start(self) -> None:
+        # release the memory cached while scoring the previous validation epoch here rather
+        # than inside the (collective) validation epoch-end hook
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
 
     def model_step(self, batch: Any):
         # input_ids, input_mask, segment_ids, video, video_mask = batch.values()
@@ -123,116 +335,124 @@ class XCLIPLitModule(LightningModule):
 
     def on_validation_start(self) -> None:
         self.valid_step_outputs[:] = []
+        self._d2h_events[:] = []
+        self._spill = None
 
+    @torch.inference_mode()
     def validation_step(self, batch: Any, batch_idx: int):
         (sequence_output, seq_features), visual_output = self.model.get_sequence_visual_output(
             **batch
         )
 
-        loss = self.model_step(batch)
+        # derive the loss from the same encoder outputs instead of a second forward pass
+        loss = self.model.get_loss(
+            sequence_output,
+            seq_features,
+            visual_output,
+            batch["attention_mask"],
+            batch["video_mask"],
+        )
         self.val_loss.update(loss)
         # update and log metrics
         self.log("val/loss", self.val_loss, on_step=True, on_epoch=True, prog_bar=True)
 
-        # keep outputs in CPU to void OOM
+        # keep outputs in CPU to void OOM, unless they fit on the device
         self.valid_step_outputs.append(
-            {
-                "sequence_output": sequence_output.data.cpu(),
-                "seq_features": seq_features.data.cpu(),
-                "visual_output": visual_output.data.cpu(),
-                "is_query": batch["is_query"].data.cpu(),
-                "is_pool": batch["is_pool"].data.cpu(),
-                "recipe_id": batch["recipe_id"].data.cpu(),
-                "kitchen_id": batch["kitchen_id"].data.cpu(),
-                "ap_id": batch["ap_id"].data.cpu(),
-                "attention_mask": batch["attention_mask"].data.cpu(),
-                "video_mask": batch["video_mask"].data.cpu(),
-            }
+            self._offload_step_outputs(
+                {
+                    "sequence_output": sequence_output,
+                    "seq_features": seq_features,
+                    "visual_output": visual_output,
+                    "is_query": batch["is_query"],
+                    "is_pool": batch["is_pool"],
+                    "recipe_id": batch["recipe_id"],
+                    "kitchen_id": batch["kitchen_id"],
+                    "ap_id": batch["ap_id"],
+                    "attention_mask": batch["attention_mask"],
+                    "video_mask": batch["video_mask"],
+                }
+            )
         )
 
     def on_validation_epoch_end(self):
-        # gather_object should be executed on all nodes
-        valid_step_outputs = self._gather_outputs(obj=self.valid_step_outputs)
-        valid_step_outputs = self.valid_step_outputs
+        self._wait_step_outputs()
+
+        # all_gather should be executed on all nodes; the per-step outputs are released while
+        # they are concatenated, and the concatenation while it is gathered
+        valid_step_outputs = self._gather_outputs(_local_concat(self.valid_step_outputs))
+
+        self._reset_scalar_metrics("val/")
 
         # run the validation only on rank 0
         if self.trainer.is_global_zero:
             v2t_metrics, _, _ = self._compute_v2t_metrics(valid_step_outputs)
 
             # update metrics
-            self.val_m1_recall_at_1.update(v2t_metrics["M1-R1"])
-            self.val_m1_recall_at_5.update(v2t_metrics["M1-R5"])
-            self.val_m1_recall_at_10.update(v2t_metrics["M1-R10"])
-            self.val_m2_recall_at_1.update(v2t_metrics["M2-R1"])
-            self.val_m2_recall_at_5.update(v2t_metrics["M2-R5"])
-            self.val_m2_recall_at_10.update(v2t_metrics["M2-R10"])
+            self._update_scalar_metric("val/M1-R@1", v2t_metrics["M1-R1"])
+            self._update_scalar_metric("val/M1-R@5", v2t_metrics["M1-R5"])
+            self._update_scalar_metric("val/M1-R@10", v2t_metrics["M1-R10"])
+            self._update_scalar_metric("val/M2-R@1", v2t_metrics["M2-R1"])
+            self._update_scalar_metric("val/M2-R@5", v2t_metrics["M2-R5"])
+            self._update_scalar_metric("val/M2-R@10", v2t_metrics["M2-R10"])
 
         # required to run on every nodes to avoid locking
-        self.log_on_epoch("val/M1-R@1", self.val_m1_recall_at_1)
-        self.log_on_epoch("val/M1-R@5", self.val_m1_recall_at_5)
-        self.log_on_epoch("val/M1-R@10", self.val_m1_recall_at_10)
-        self.log_on_epoch("val/M2-R@1", self.val_m2_recall_at_1)
-        self.log_on_epoch("val/M2-R@5", self.val_m2_recall_at_5)
-        self.log_on_epoch("val/M2-R@10", self.val_m2_recall_at_10)
-
+        self._log_scalar_metrics("val/")
 
     def on_test_start(self) -> None:
         self.test_step_outputs[:] = []
+        self._d2h_events[:] = []
+        self._spill = None
 
+    @torch.inference_mode()
     def test_step(self, batch: Any, batch_idx: int):
         (sequence_output, seq_features), visual_output = self.model.get_sequence_visual_output(
             **batch
         )
 
-        # keep outputs in CPU to void OOM
+        # keep outputs in CPU to void OOM, unless they fit on the device
         self.test_step_outputs.append(
-            {
-                "sequence_output": sequence_output.data.cpu(),
-                "seq_features": seq_features.data.cpu(),
-                "visual_output": visual_output.data.cpu(),
-                "is_query": batch["is_query"].data.cpu(),
-                "is_pool": batch["is_pool"].data.cpu(),
-                "recipe_id": batch["recipe_id"].data.cpu(),
-                "kitchen_id": batch["kitchen_id"].data.cpu(),
-                "ap_id": batch["ap_id"].data.cpu(),
-                "attention_mask": batch["attention_mask"].data.cpu(),
-                "video_mask": batch["video_mask"].data.cpu(),
-            }
+            self._offload_step_outputs(
+                {
+                    "sequence_output": sequence_output,
+                    "seq_features": seq_features,
+                    "visual_output": visual_output,
+                    "is_query": batch["is_query"],
+                    "is_pool": batch["is_pool"],
+                    "recipe_id": batch["recipe_id"],
+                    "kitchen_id": batch["kitchen_id"],
+                    "ap_id": batch["ap_id"],
+                    "attention_mask": batch["attention_mask"],
+                    "video_mask": batch["video_mask"],
+                }
+            )
         )
 
     def on_test_epoch_end(self):
-        # gather_object should be executed on each node?
-        test_step_outputs = self._gather_outputs(obj=self.test_step_outputs)
+        self._wait_step_outputs()
+
+        # all_gather should be executed on all nodes; the per-step outputs are released while
+        # they are concatenated, and the concatenation while it is gathered
+        test_step_outputs = self._gather_outputs(_local_concat(self.test_step_outputs))
+
+        self._reset_scalar_metrics("test/")
 
         # run the validation only on rank 0
         if self.trainer.is_global_zero:
             v2t_metrics, n_seq, n_vid = self._compute_v2t_metrics(test_step_outputs)
 
-            # self.test_feasible_recall_at_1.update(v2t_metrics["FEAS-R1"])
-            # self.test_feasible_recall_at_5.update(v2t_metrics["FEAS-R5"])
-            # self.test_feasible_recall_at_10.update(v2t_metrics["FEAS-R10"])
-            # self.test_feasible_median.update(v2t_metrics["FEAS-median"])
-            self.test_m2_recall_at_1.update(v2t_metrics["M2-R1"])
-            self.test_m2_recall_at_5.update(v2t_metrics["M2-R5"])
-            self.test_m2_recall_at_10.update(v2t_metrics["M2-R10"])
-            self.test_m2_median.update(v2t_metrics["M2-median"])
-            self.test_n_seq.update(n_seq)
-            self.test_n_vid.update(n_vid)
+            # self._update_scalar_metric("test/FEAS-R@1", v2t_metrics["FEAS-R1"])
+            # self._update_scalar_metric("test/FEAS-R@5", v2t_metrics["FEAS-R5"])
+            # self._update_scalar_metric("test/FEAS-R@10", v2t_metrics["FEAS-R10"])
+            # self._update_scalar_metric("test/FEAS-median", v2t_metrics["FEAS-median"])
+            self._update_scalar_metric("test/M2-R@1", v2t_metrics["M2-R1"])
+            self._update_scalar_metric("test/M2-R@5", v2t_metrics["M2-R5"])
+            self._update_scalar_metric("test/M2-R@10", v2t_metrics["M2-R10"])
+            self._update_scalar_metric("test/M2-median", v2t_metrics["M2-median"])
+            self._update_scalar_metric("test/n_seq", n_seq)
+            self._update_scalar_metric("test/n_vid", n_vid)
 
         # required to run on every nodes to avoid locking
-
-        # self.log("test/FEAS-R@1", self.test_feasible_recall_at_1)
-        # self.log("test/FEAS-R@5", self.test_feasible_recall_at_5)
-        # self.log("test/FEAS-R@10", self.test_feasible_recall_at_10)
-        # self.log("test/FEAS-median", self.test_feasible_median)
-
-        self.log("test/M2-R@1", self.test_m2_recall_at_1)
-        self.log("test/M2-R@5", self.test_m2_recall_at_5)
-        self.log("test/M2-R@10", self.test_m2_recall_at_10)
-        self.log("test/M2-median", self.test_m2_median)
-
-        self.log("test/n_seq", self.test_n_seq)
-        self.log("test/n_vid", self.test_n_vid)
+        self._log_scalar_metrics("test/", prog_bar=False)
 
     def configure_optimizers(self):
         num_train_optimization_steps = (
@@ -245,37 +465,40 @@ class XCLIPLitModule(LightningModule):
         ) * self.hparams.task_config.epochs
         optimizer = None
 
-        if hasattr(self.model, "module"):
-            self.model = self.model.module
+        # unwrap DataParallel/DistributedDataParallel if any
+        self.model = getattr(self.model, "module", self.model)
 
         param_optimizer = list(self.model.named_parameters())
-        no_decay = ["bias", "LayerNorm.bias", "LayerNorm.weight"]
-
-        decay_param_tp = [
-            (n, p) for n, p in param_optimizer if not any(nd in n for nd in no_decay)
-        ]
-        no_decay_param_tp = [(n, p) for n, p in param_optimizer if any(nd in n for nd in no_decay)]
-
-        decay_clip_param_tp = [(n, p) for n, p in decay_param_tp if "clip." in n]
-        decay_noclip_param_tp = [(n, p) for n, p in decay_param_tp if "clip." not in n]
-
-        no_decay_clip_param_tp = [(n, p) for n, p in no_decay_param_tp if "clip." in n]
-        no_decay_noclip_param_tp = [(n, p) for n, p in no_decay_param_tp if "clip." not in n]
+        no_decay = ("bias", "LayerNorm.bias", "LayerNorm.weight")
+        # one scan per name instead of one substring search per no_decay entry
+        no_decay_pattern = re.compile("|".join(map(re.escape, no_decay)))
+
+        # partition parameters by (decay/no-decay, clip/non-clip) in a single pass
+        param_groups = {
+            "decay_clip": [],
+            "decay_noclip": [],
+            "no_decay_clip": [],
+            "no_decay_noclip": [],
+        }
+        for n, p in param_optimizer:
+            decay = "no_decay" if no_decay_pattern.search(n) else "decay"
+            clip = "clip" if "clip." in n else "noclip"
+            param_groups[f"{decay}_{clip}"].append(p)
 
         weight_decay = 0.2
         optimizer_grouped_parameters = [
             {
-                "params": [p for n, p in decay_clip_param_tp],
+                "params": param_groups["decay_clip"],
                 "weight_decay": weight_decay,
                 "lr": self.hparams.task_config.lr * self.hparams.task_config.coef_lr,
             },
-            {"params": [p for n, p in decay_noclip_param_tp], "weight_decay": weight_decay},
+            {"params": param_groups["decay_noclip"], "weight_decay": weight_decay},
             {
-                "params": [p for n, p in no_decay_clip_param_tp],
+                "params": param_groups["no_decay_clip"],
                 "weight_decay": 0.0,
                 "lr": self.hparams.task_config.lr * self.hparams.task_config.coef_lr,
             },
-            {"params": [p for n, p in no_decay_noclip_param_tp], "weight_decay": 0.0},
+            {"params": param_groups["no_decay_noclip"], "weight_decay": 0.0},
         ]
 
         optimizer = BertAdam(
@@ -304,51 +527,66 @@ class XCLIPLitModule(LightningModule):
         if device is None:
             device = next(self.model.parameters()).device
 
-        # keep outputs on CPU unitll pass them to the model
-        sequence_output = torch.cat([o["sequence_output"] for o in outputs])
-        seq_features = torch.cat([o["seq_features"] for o in outputs])
-        visual_output = torch.cat([o["visual_output"] for o in outputs])
-        attention_mask = torch.cat([o["attention_mask"] for o in outputs])
-        video_mask = torch.cat([o["video_mask"] for o in outputs])
-        recipe_kitchen_ap_ids = torch.stack(
-            [
-                torch.cat([o["recipe_id"] for o in outputs]),
-                torch.cat([o["kitchen_id"] for o in outputs]),
-                torch.cat([o["ap_id"] for o in outputs]),
-            ]
-        ).T
-        is_query = torch.cat([o["is_query"] for o in outputs])
-        is_pool = torch.cat([o["is_pool"] for o in outputs])
+        # move the full outputs to the device once (a no-op if they were not spilled to host
+        # memory) and select query/pool there; popping them releases each full tensor as soon
+        # as its selection is made
+        sequence_output = outputs.pop("sequence_output").to(device, non_blocking=True)
+        seq_features = outputs.pop("seq_features").to(device, non_blocking=True)
+        visual_output = outputs.pop("visual_output").to(device, non_blocking=True)
+        attention_mask = outputs.pop("attention_mask").to(device, non_blocking=True)
+        video_mask = outputs.pop("video_mask").to(device, non_blocking=True)
+        # ids are kept as separate int32 columns
+        recipe_id = outputs.pop("recipe_id").to(device, dtype=torch.int32, non_blocking=True)
+        kitchen_id = outputs.pop("kitchen_id").to(device, dtype=torch.int32, non_blocking=True)
+        ap_id = outputs.pop("ap_id").to(device, dtype=torch.int32, non_blocking=True)
+        is_query = outputs.pop("is_query").to(device, non_blocking=True)
+        is_pool = outputs.pop("is_pool").to(device, non_blocking=True)
 
         # query
-        visual_output = visual_output[is_query].to(device)
-        video_mask = video_mask[is_query].to(device)
+        visual_output = visual_output[is_query]
+        video_mask = video_mask[is_query]
 
         # pool
-        sequence_output = sequence_output[is_pool].to(device)
-        seq_features = seq_features[is_pool].to(device)
-        attention_mask = attention_mask[is_pool].to(device)
-
-        # similarity matrix
-        retrieve_logits, _ = self.model.get_similarity_logits(
-            sequence_output,
-            seq_features,
-            visual_output,
-            attention_mask,
-            video_mask,
-            loose_type=self.model.loose_type,
+        sequence_output = sequence_output[is_pool]
+        seq_features = seq_features[is_pool]
+        attention_mask = attention_mask[is_pool]
+
+        # similarity matrix (n_vis, n_seq), computed for a chunk of videos at a time to bound
+        # the fine-grained (n_seq, n_words, n_vis, n_frames) intermediates
+        chunk_size = self.hparams.task_config.get("sim_chunk_size", 256)
+        # bf16 is opt-in: it rounds near-equal logits into ties, which inflates recall
+        use_bf16 = (
+            self.hparams.task_config.get("sim_bf16", False)
+            and device.type == "cuda"
+            and torch.cuda.is_bf16_supported()
         )
-        # (n_seq, n_vis) -> (n_vis, n_seq)
-        retrieve_logits = retrieve_logits.T
+        n_vis, n_seq = visual_output.size(0), sequence_output.size(0)
+        retrieve_logits = torch.empty((n_vis, n_seq), dtype=torch.float32, device=device)
+        for i in range(0, n_vis, chunk_size):
+            with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=use_bf16):
+                chunk_logits, _ = self.model.get_similarity_logits(
+                    sequence_output,
+                    seq_features,
+                    visual_output[i : i + chunk_size],
+                    attention_mask,
+                    video_mask[i : i + chunk_size],
+                    loose_type=self.model.loose_type,
+                )
+            # (n_seq, chunk) -> (chunk, n_seq)
+            retrieve_logits[i : i + chunk_size].copy_(chunk_logits.T)
 
         scores = compute_scores(
             retrieve_logits,
-            recipe_kitchen_ap_ids[is_pool].to(device),
-            recipe_kitchen_ap_ids[is_query].to(device),
+            recipe_id[is_pool],
+            kitchen_id[is_pool],
+            ap_id[is_pool],
+            recipe_id[is_query],
+            kitchen_id[is_query],
+            ap_id[is_query],
             stage=self.hparams.task_config.stage,
         )
 
-        return scores, sum(is_pool), sum(is_query)
+        return scores, is_pool.sum().item(), is_query.sum().item()
 
 
 if __name__ == "__main__":
@@ -7,6 +7,12 @@ def rank_tensor(t: torch.Tensor, dim=-1, method: str = None) -> torch.Tensor:
 
     if method is None:
         return t.argsort(dim=dim).argsort(dim=dim)
+    elif method == "min":
+        # the "min" rank is the number of strictly smaller elements, which searchsorted
+        # gives without leaving the device
+        t = t.transpose(dim, -1).contiguous()
+        ranks = torch.searchsorted(t.sort(dim=-1)[0], t, side="left")
+        return ranks.transpose(dim, -1)
     else:
         # ranks by scipy.stats.rankdata starts from 1 (0 for torch.argsort)
         ranks = scipy.stats.rankdata(t.cpu(), axis=dim, method=method) - 1
@@ -0,0 +1,76 @@
+import pytest
+import scipy.stats
+import torch
+
+from com_kitchens.models.components.metrics.retrieval_metrics import compute_scores
+from com_kitchens.utils.pytorch import rank_tensor, scatter_min_2d_label
+
+
+def _baseline_v2t_score(sim_logits, matched_mask, pool_mask=None, at=1):
+    if pool_mask is not None:
+        sim_logits = sim_logits.masked_fill(~pool_mask, torch.inf)
+
+    ranks = scipy.stats.rankdata(sim_logits, axis=-1, method="min") - 1
+    ranks = torch.from_numpy(ranks).to(dtype=torch.int64)
+
+    min_ranks = ranks.masked_fill(~matched_mask, ranks.max() + 1).min(dim=-1)[0]
+    if at == "median":
+        return float(torch.median(min_ranks))
+    return float(sum(min_ranks < at)) * 100 / len(min_ranks)
+
+
+def _baseline_matched_matrix(seq_ids, vid_ids):
+    n_vid = vid_ids.size(0)
+    n_seq = seq_ids.size(0)
+
+    vid_ids = vid_ids.unsqueeze(1).repeat(1, n_seq, 1)
+    seq_ids = seq_ids.unsqueeze(0).repeat(n_vid, 1, 1)
+
+    return (vid_ids == seq_ids).all(dim=-1)
+
+
+def _baseline_compute_scores(sim_matrix, sequence_ids, video_ids):
+    agg_sim_logits, agg_seq_ids = scatter_min_2d_label(sim_matrix.T, sequence_ids[:, :2])
+    m1_mask = _baseline_matched_matrix(agg_seq_ids, video_ids[:, :2])
+
+    m2_pool_mask = _baseline_matched_matrix(sequence_ids[:, :2], video_ids[:, :2])
+    m2_mask = _baseline_matched_matrix(sequence_ids, video_ids)
+
+    metrics = {}
+    for at, name in [(1, "R1"), (5, "R5"), (10, "R10"), ("median", "median")]:
+        metrics[f"M1-{name}"] = _baseline_v2t_score(agg_sim_logits.T, m1_mask, at=at)
+        metrics[f"M2-{name}"] = _baseline_v2t_score(
+            sim_matrix, m2_mask, pool_mask=m2_pool_mask, at=at
+        )
+
+    return metrics
+
+
+@pytest.mark.parametrize("masked", [False, True])
+def test_rank_tensor_min(masked):
+    generator = torch.Generator().manual_seed(0)
+
+    # few distinct values, so that every row has ties
+    t = torch.randint(0, 5, (8, 32), generator=generator).float()
+    if masked:
+        t = t.masked_fill(torch.rand(t.shape, generator=generator) < 0.3, torch.inf)
+
+    expected = scipy.stats.rankdata(t, axis=-1, method="min") - 1
+
+    assert torch.equal(rank_tensor(t, method="min"), torch.from_numpy(expected))
+    assert torch.equal(rank_tensor(t.T, dim=0, method="min"), torch.from_numpy(expected).T)
+
+
+def test_compute_scores_matches_baseline():
+    generator = torch.Generator().manual_seed(0)
+    n_vid, n_seq = 24, 64
+
+    # small id ranges, so that recipes, kitchens and aps collide between pool and queries
+    video_ids = torch.randint(0, 3, (n_vid, 3), generator=generator, dtype=torch.int32)
+    sequence_ids = torch.randint(0, 3, (n_seq, 3), generator=generator, dtype=torch.int32)
+    # rounded logits, so that ranks have ties
+    sim_matrix = torch.randn(n_vid, n_seq, generator=generator).round(decimals=1)
+
+    metrics = compute_scores(sim_matrix, *sequence_ids.unbind(dim=1), *video_ids.unbind(dim=1))
+
+    assert metrics == pytest.approx(_baseline_compute_scores(sim_matrix, sequence_ids, video_ids))